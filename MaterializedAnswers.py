@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import pandas as pd
+from utils import resource_path, ensure_dir, nice_print
+
+
+class MaterializedAnswers:
+    """
+    A background scheduler that precomputes the answers of the most popular saved questions.
+
+    Every refresh interval the most frequently reused questions in the QuestionDatabase are executed
+    and their result tables are stored locally as parquet files, next to a metadata file recording
+    the SQL code that produced them and when they were refreshed.
+
+    Attributes:
+        STORE_DIR (str): Directory holding one sub-directory of materialized tables per question.
+        META_FILE (str): Name of the metadata file inside each question directory.
+    """
+    STORE_DIR = resource_path("Data/materialized")
+    META_FILE = "meta.json"
+
+    def __init__(self, question_db, execute_sql, refresh_interval=3600, max_age=7200, top_questions=5):
+        """
+        Initialize the MaterializedAnswers instance.
+
+        Args:
+            question_db (QuestionDatabase): The database of saved questions and their hit counts.
+            execute_sql (Callable): Executes saved SQL code, returning (tables, succeeded) like NLtoSQL does.
+            refresh_interval (int): Seconds between two refreshes of the popular questions.
+            max_age (int): Maximum age in seconds of a materialized answer that may still be served.
+            top_questions (int): Number of most popular questions to keep materialized.
+        """
+        self.__question_db = question_db
+        self.__execute_sql = execute_sql
+        self.__refresh_interval = refresh_interval
+        self.__max_age = max_age
+        self.__top_questions = top_questions
+        self.__stop_event = threading.Event()
+        self.__thread = None
+
+    def start(self, delay_first=False):
+        """
+        Start refreshing the popular questions in a background thread.
+
+        Args:
+            delay_first (bool): Whether to wait one refresh interval before the first refresh.
+        """
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target=self.__run, args=(delay_first,), daemon=True)
+        self.__thread.start()
+
+    def stop(self, timeout=5):
+        """
+        Stop the background thread.
+
+        A refresh checks for the stop request only between questions, so waiting is bounded by the timeout
+        rather than by a running query. The thread is a daemon and is abandoned if it does not finish in time.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait for a running refresh to finish.
+        """
+        self.__stop_event.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+            self.__thread = None
+
+    def refresh(self):
+        """
+        Materialize the most popular saved questions whose stored answer is older than the refresh interval,
+        and remove the stored answers of questions that are no longer popular.
+        """
+        popular_questions = self.__question_db.get_popular_questions(self.__top_questions)
+        self.__remove_unpopular(popular_questions)
+        for question in popular_questions:
+            if self.__stop_event.is_set():
+                return
+            sql_code = self.__question_db.get_sql_for_question(question)
+            try:
+                meta = self.__load_meta(question)
+                if meta and meta["sql_code"] == MaterializedAnswers.__as_json(sql_code) \
+                        and time.time() - meta["refreshed_at"] < self.__refresh_interval:
+                    continue
+                data_tables, succeeded = self.__execute_sql(sql_code)
+                if succeeded:
+                    self.__store(question, sql_code, data_tables)
+            except Exception:
+                # A failing question must not stop the refresh of the others, its old answer simply goes stale
+                continue
+
+    def get_fresh(self, question, sql_code):
+        """
+        Get the materialized answer of a question if it is fresh enough.
+
+        Args:
+            question (str): The saved question.
+            sql_code (list): The SQL code currently saved for the question.
+
+        Returns:
+            tuple: The list of (table name, DataFrame) tuples and the answer age in seconds,
+                   or None if there is no fresh answer for this SQL code.
+        """
+        try:
+            meta = self.__load_meta(question)
+            if not meta or meta["sql_code"] != MaterializedAnswers.__as_json(sql_code):
+                return None
+            age = time.time() - meta["refreshed_at"]
+            if age > self.__max_age:
+                return None
+            question_dir = self.__question_dir(question)
+            data_tables = [(table["name"], pd.read_parquet(os.path.join(question_dir, table["file"])))
+                           for table in meta["tables"]]
+        except Exception:
+            return None
+        return data_tables, age
+
+    @staticmethod
+    def __as_json(sql_code):
+        # SQL codes saved during this session are tuples, the stored ones were read back from JSON as lists
+        return json.loads(json.dumps(sql_code))
+
+    def __run(self, delay_first):
+        if delay_first:
+            self.__stop_event.wait(self.__refresh_interval)
+        while not self.__stop_event.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep the thread alive so the next interval gets another chance
+                nice_print(f"Refreshing the precomputed answers failed: {e}")
+            self.__stop_event.wait(self.__refresh_interval)
+
+    def __remove_unpopular(self, popular_questions):
+        if not os.path.exists(MaterializedAnswers.STORE_DIR):
+            return
+        popular_dirs = {os.path.basename(self.__question_dir(question)) for question in popular_questions}
+        for entry in os.listdir(MaterializedAnswers.STORE_DIR):
+            if entry not in popular_dirs:
+                shutil.rmtree(os.path.join(MaterializedAnswers.STORE_DIR, entry), ignore_errors=True)
+
+    def __question_dir(self, question):
+        return os.path.join(MaterializedAnswers.STORE_DIR, hashlib.sha1(question.encode()).hexdigest())
+
+    def __load_meta(self, question):
+        meta_path = os.path.join(self.__question_dir(question), MaterializedAnswers.META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                return json.load(f)
+        return None
+
+    def __store(self, question, sql_code, data_tables):
+        """
+        Write the result tables of a question to parquet files, then its metadata.
+
+        The tables are written to a temporary directory that replaces the old one only once complete,
+        so a reader never sees a half written answer.
+        """
+        ensure_dir(MaterializedAnswers.STORE_DIR)
+        question_dir = self.__question_dir(question)
+        tmp_dir = question_dir + ".tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        tables = []
+        for i, (name, df) in enumerate(data_tables):
+            file_name = f"table_{i}.parquet"
+            df.to_parquet(os.path.join(tmp_dir, file_name), index=False)
+            tables.append({"name": name, "file": file_name, "rows": len(df)})
+
+        refreshed_at = time.time()
+        meta = {
+            "question": question,
+            "sql_code": sql_code,
+            "refreshed_at": refreshed_at,
+            "refreshed_at_iso": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(refreshed_at)),
+            "tables": tables
+        }
+        with open(os.path.join(tmp_dir, MaterializedAnswers.META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+        if os.path.exists(question_dir):
+            shutil.rmtree(question_dir)
+        os.rename(tmp_dir, question_dir)
@@ -1,5 +1,7 @@
+import threading
 import anthropic
 import utils
+from MaterializedAnswers import MaterializedAnswers
 from QuestionDatabase import QuestionDatabase
 from utils import nice_print, get_tags_info
 import pandas as pd
@@ -15,7 +17,8 @@ class NLtoSQL:
     Attributes:
         MISSION1_PROMPT (str): File path for the first mission prompt.
         MISSION2_PROMPT (str): File path for the second mission prompt.
-        FIXER2 (str): A template for fixing erroneous SQL code.
+        FIXER1 (str): A follow-up message asking to fix an erroneous table selection.
+        FIXER2 (str): A follow-up message asking to fix erroneous SQL code.
     """
     # List of tables to always include
     ESSENTIAL_TABLES = [
@@ -29,32 +32,45 @@ class NLtoSQL:
     SIMILAR_QUESTION_PROMPT = utils.resource_path("Prompt_helpers/SIMILAR_QUESTION_PROMPT")
     MISSION1_PROMPT = utils.resource_path("Prompt_helpers/MISSION1")
     MISSION2_PROMPT = utils.resource_path("Prompt_helpers/MISSION2")
-    FIXER1 = """Last time I gave you the following prompt:\n{MAIN_PROMPT}\nYou returned:\n{RESPONSE}
-    I got this massage while trying to find the tables:\n{E}\n.
+    FIXER1 = """I got this massage while trying to find the tables from your answer:\n{E}\n.
     try to fix your answer so it will 100% work(also if needed check that all tables exist in the tables given to you).
     You should return with the same format, giving a reasoning for the rest of the code. 
     You should act in your reasoning like you never made a mistake in the first place.
     Meaning that in <reasoning> you only explain what information you decided to give, and in <errorhandling> you explain what changes you made for the code for that to work.
     Remember to adjust the tablenames if needed."""
-    FIXER2 = """Last time I gave you the following prompt:\n{MAIN_PROMPT}\nYou returned:\n{RESPONSE}
-    I got this massage while trying to run code {I}:\n{E}\n Now in your answer, try to fix the code but be 100% it will work (also look at codes after {I} and check them).
+    FIXER2 = """I got this massage while trying to run code {I} from your answer:\n{E}\n Now in your answer, try to fix the code but be 100% it will work (also look at codes after {I} and check them).
     You should return with the same format, giving a reasoning for the rest of the code. 
     You should act in your reasoning like you never made a mistake in the first place.
     Meaning that in <reasoning> you only explain what information you decided to give, and in <errorhandling> you explain what changes you made for the code for that to work.
     Remember to adjust the tablenames if needed aswell. """
+    # Beta header enabling provider-side caching of the prompt up to each block marked with cache_control
+    PROMPT_CACHING_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
 
-    def __init__(self, tries=2):
+    def __init__(self, tries=2, compact_results=False, refresh_interval=3600, max_answer_age=7200):
         """
         Initialize the NLtoSQL instance.
 
         Args:
             tries (int): The number of attempts to make when generating SQL queries.
+            compact_results (bool): Whether to shrink the memory footprint of retrieved DataFrames.
+            refresh_interval (int): Seconds between background refreshes of popular saved questions.
+            max_answer_age (int): Maximum age in seconds of a precomputed answer that may be served.
         """
         self.__claude_client = anthropic.Anthropic()
         self.__cur_connection = None
+        self.__refresh_connection = None
         self.__tables_dict = None
         self.__tries = tries
+        self.__compact_results = compact_results
+        self.__token_usage = []
+        # Without a dedicated connection the background refresh shares the user's one,
+        # which pyodbc does not allow to use concurrently
+        self.__sql_lock = threading.Lock()
         self.question_db = QuestionDatabase()
+        self.__materialized = MaterializedAnswers(self.question_db,
+                                                  lambda sql_code: self.__execute_sql(sql_code, quiet=True,
+                                                                                      background=True),
+                                                  refresh_interval=refresh_interval, max_age=max_answer_age)
         with open(NLtoSQL.MISSION1_PROMPT, 'r') as file:
             self.__prompt1 = file.read()
         with open(NLtoSQL.MISSION2_PROMPT, 'r') as file:
@@ -75,15 +91,31 @@ class NLtoSQL:
         """
         return False if self.__cur_connection is None else True
 
-    def connect_to_server(self, connection):
+    def connect_to_server(self, connection, refresh_connection=None, refresh_answers=True):
         """
         Connect to a SQL server and retrieve table information.
 
         Args:
             connection: A database connection object.
+            refresh_connection: An optional dedicated connection for refreshing precomputed answers in the
+                                background. Without it the refresh shares `connection` with the user's queries,
+                                so its first run is delayed by one refresh interval.
+            refresh_answers (bool): Whether to refresh precomputed answers in the background. The refresh only
+                                    starts if some saved question has already been reused.
         """
         self.__cur_connection = connection
+        self.__refresh_connection = refresh_connection
         self.__tables_dict = self.__get_tables()
+        if refresh_answers and self.question_db.get_popular_questions(1):
+            self.__materialized.start(delay_first=refresh_connection is None)
+
+    def disconnect_from_server(self):
+        """
+        Stop refreshing precomputed answers before the connections are closed, waiting a few seconds at most.
+        """
+        self.__materialized.stop()
+        self.__cur_connection = None
+        self.__refresh_connection = None
 
     def apply(self, question):
         """
@@ -99,6 +131,7 @@ class NLtoSQL:
             tuple: A tuple containing the SQL code, retrieved data and whether the answer was in the database or not.
                    Returns None if an error was found.
         """
+        self.__token_usage = []
         similar_question = self.__find_similar_question(question)
         if similar_question != "No similar question found.":
             nice_print(f"I found a similar question in the database: '{similar_question}'")
@@ -106,24 +139,29 @@ class NLtoSQL:
             if user_approval == 'y':
                 sql_code = self.question_db.get_sql_for_question(similar_question)
                 if sql_code:
+                    self.question_db.record_hit(similar_question)
+                    materialized = self.__materialized.get_fresh(similar_question, sql_code)
+                    if materialized:
+                        data_tables, age = materialized
+                        nice_print(f"Using the precomputed answer for this question "
+                                   f"(refreshed {int(age // 60)} minutes ago).")
+                        return sql_code, data_tables, True
                     nice_print("Using the saved SQL code for this question.")
                     return sql_code, self.__execute_sql(sql_code)[0], True
             else:
                 nice_print(f"Proceeding as usual, please wait while I am getting the information.")
-        prompt = self.__prompt1.format(QUESTION=question, TABLE_LIST=str(self.__tables_dict.keys()))
-        main_prompt = prompt
+        messages = [NLtoSQL.__cached_prefix_message(self.__prompt1, question,
+                                                    TABLE_LIST=str(self.__tables_dict.keys()))]
         for i in range(self.__tries):
+            table_picker_message = self.__converse(
+                stage="table_picker",
+                attempt=i,
+                max_tokens=1500,
+                system="You are an AI assistant tasked with analyzing a user's question about a database,"
+                       " determining its validity, and identifying relevant tables if the question is valid.",
+                messages=messages
+            )
             try:
-                table_picker_message = self.__claude_client.messages.create(
-                    model="claude-3-5-sonnet-20240620",
-                    max_tokens=1500,
-                    temperature=0,
-                    system="You are an AI assistant tasked with analyzing a user's question about a database,"
-                           " determining its validity, and identifying relevant tables if the question is valid.",
-                    messages=[
-                        {"role": "user", "content": [{"type": "text", "text": prompt}]}
-                    ]
-                ).content[0].text
                 if "<error>" in table_picker_message:
                     nice_print('\n' + get_tags_info(table_picker_message, tag="error") + '\n')
                     return None, None, None
@@ -133,20 +171,23 @@ class NLtoSQL:
                                range(len(tables))]
                 break
             except Exception as e:
-                prompt = NLtoSQL.FIXER1.format(MAIN_PROMPT=main_prompt, RESPONSE=table_picker_message, E=e)
+                # Only the error is new input on retry, the earlier conversation is read from the cache
+                messages += [{"role": "assistant", "content": table_picker_message},
+                             {"role": "user", "content": NLtoSQL.FIXER1.format(E=e)}]
+        else:
+            return None, None, None
+        # The column-level table info changes with the question, so the cache only serves the retries below
         prompt = self.__prompt2.format(QUESTION=question, TABLE_INFO=str(tables_info), REASONING=table_picker_reasoning)
-        main_prompt = prompt
+        messages = [{"role": "user", "content": [{"type": "text", "text": prompt,
+                                                  "cache_control": {"type": "ephemeral"}}]}]
         for i in range(self.__tries):
-            coder_response = self.__claude_client.messages.create(
-                model="claude-3-5-sonnet-20240620",
+            coder_response = self.__converse(
+                stage="coder",
+                attempt=i,
                 max_tokens=4000,
-                temperature=0,
                 system="You are a microsoft SQL coder, please be sure that the code you generate works on microsoft SQL",
-                messages=[
-                    {"role": "user", "content": [{"type": "text", "text": prompt}]
-                     }
-                ]
-            ).content[0].text
+                messages=messages
+            )
             if "<error>" in coder_response:
                 nice_print('\n' + get_tags_info(coder_response, tag="error") + '\n')
                 return None, None, None
@@ -159,10 +200,99 @@ class NLtoSQL:
                 nice_print("Data extracted:\n" + columns_reasoning + '\n')
                 return SQLcodes, data_tables[0], False
             else:
-                prompt = NLtoSQL.FIXER2.format(MAIN_PROMPT=main_prompt, RESPONSE=coder_response,
-                                               I=data_tables[0][0], E=data_tables[0][1])
+                messages += [{"role": "assistant", "content": coder_response},
+                             {"role": "user", "content": NLtoSQL.FIXER2.format(I=data_tables[0][0],
+                                                                               E=data_tables[0][1])}]
         return None, None, None
 
+    def get_token_usage(self):
+        """
+        Get the token usage recorded for every model call made by the last apply().
+
+        Returns:
+            list: A list of dictionaries, one per attempt, with the input, cached and output token counts.
+        """
+        return self.__token_usage
+
+    @staticmethod
+    def __cached_prefix_message(template, question, **kwargs):
+        """
+        Build the opening user message, caching everything before the question as a prompt prefix.
+
+        In MISSION1 the instructions and the list of table names come before {QUESTION} and are the same
+        for every question, so they are sent as a separate block marked for provider-side caching.
+
+        Args:
+            template (str): The mission prompt template.
+            question (str): The user's question.
+            **kwargs: The other values to format the template with.
+
+        Returns:
+            dict: A user message with a cached prefix block and an uncached question block.
+        """
+        prefix, suffix = template.split("{QUESTION}", 1)
+        return {"role": "user", "content": [
+            {"type": "text", "text": prefix.format(**kwargs), "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": question + suffix.format(**kwargs)}
+        ]}
+
+    @staticmethod
+    def __mark_latest_turn(messages):
+        """
+        Mark the newest retry turn for caching, so a further retry reads the whole conversation so far from the cache.
+
+        Args:
+            messages (list): The conversation so far, with retry turns given as plain strings.
+
+        Returns:
+            list: A copy of the conversation whose newest turn is marked for prompt caching.
+        """
+        latest = messages[-1]
+        if isinstance(latest["content"], str):
+            latest = {"role": latest["role"],
+                      "content": [{"type": "text", "text": latest["content"], "cache_control": {"type": "ephemeral"}}]}
+        return messages[:-1] + [latest]
+
+    def __converse(self, stage, attempt, max_tokens, system, messages):
+        """
+        Send a conversation to the model and record the token usage.
+
+        The opening message carries its own cache marker, and the newest retry turn is marked as well,
+        so each retry reads the earlier conversation from the cache and only the error is new input.
+
+        Args:
+            stage (str): The name of the mission the call belongs to.
+            attempt (int): The attempt number within the mission.
+            max_tokens (int): The maximum number of tokens to generate.
+            system (str): The system prompt.
+            messages (list): The conversation so far.
+
+        Returns:
+            str: The text of the model response.
+        """
+        response = self.__claude_client.messages.create(
+            model="claude-3-5-sonnet-20240620",
+            max_tokens=max_tokens,
+            temperature=0,
+            system=system,
+            messages=NLtoSQL.__mark_latest_turn(messages),
+            extra_headers=NLtoSQL.PROMPT_CACHING_HEADERS
+        )
+        usage = response.usage
+        cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_creation = getattr(usage, "cache_creation_input_tokens", None) or 0
+        self.__token_usage.append({
+            "stage": stage,
+            "attempt": attempt,
+            "input_tokens": usage.input_tokens,
+            "cache_creation_input_tokens": cache_creation,
+            "cache_read_input_tokens": cache_read,
+            "output_tokens": usage.output_tokens,
+            # Cache reads are billed at 0.1x the base input price and cache writes at 1.25x
+            "net_saved_input_tokens": int(0.9 * cache_read - 0.25 * cache_creation)
+        })
+        return response.content[0].text
+
     def __get_tables(self):
         """
         Retrieve table and column information from the connected database.
@@ -215,9 +345,15 @@ class NLtoSQL:
         )
         return response.content[0].text.strip()
 
-    def __execute_sql(self, sql_code):
+    def __execute_sql(self, sql_code, quiet=False, background=False):
+        if background and self.__refresh_connection is not None:
+            return self.__execute_sql_on(self.__refresh_connection, sql_code, quiet)
+        with self.__sql_lock:
+            return self.__execute_sql_on(self.__cur_connection, sql_code, quiet)
+
+    def __execute_sql_on(self, connection, sql_code, quiet):
         try:
-            cursor = self.__cur_connection.cursor()
+            cursor = connection.cursor()
             data_tables = []
             j = 0
             while j < len(sql_code):
@@ -228,7 +364,34 @@ class NLtoSQL:
                 df = pd.DataFrame(final_result_data, columns=headers)
                 data_tables.append((sql_code[j][1].strip(), df))
                 j += 1
-            return data_tables, True
         except Exception as e:
             return (j,e), False
+        # Compaction runs outside the try so its problems are never reported as SQL errors
+        if self.__compact_results:
+            data_tables = self.__compact_tables(data_tables, quiet)
+        return data_tables, True
+
+    def __compact_tables(self, data_tables, quiet=False):
+        """
+        Compact every retrieved DataFrame and report the memory saved.
 
+        Args:
+            data_tables (List[Tuple]): A list of tuples containing table name and DataFrame.
+            quiet (bool): Whether to skip the memory report, used by background refreshes.
+
+        Returns:
+            List[Tuple]: The same tables with compacted DataFrames.
+        """
+        before = sum(utils.memory_size(df) for _, df in data_tables)
+        compacted_tables = []
+        for name, df in data_tables:
+            try:
+                compacted_tables.append((name, utils.compact_dataframe(df)))
+            except Exception:
+                # Compaction is only an optimization, keep the table as retrieved
+                compacted_tables.append((name, df))
+        data_tables = compacted_tables
+        after = sum(utils.memory_size(df) for _, df in data_tables)
+        if not quiet:
+            nice_print(f"Results memory: {utils.format_bytes(before)} -> {utils.format_bytes(after)}")
+        return data_tables
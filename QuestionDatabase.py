@@ -1,5 +1,6 @@
 import json
 import os
+import threading
 from utils import resource_path
 
 
@@ -7,6 +8,10 @@ class QuestionDatabase:
     def __init__(self):
         self.db_file = resource_path("Data/answered_questions.json")
         self.questions = self.load_questions()
+        self.hits_file = resource_path("Data/question_hits.json")
+        # Hits are read by the background refresh of popular questions while the session records new ones
+        self.hits_lock = threading.Lock()
+        self.hits = self.load_hits()
 
     def load_questions(self):
         if os.path.exists(self.db_file):
@@ -26,4 +31,26 @@ class QuestionDatabase:
         return self.questions
 
     def get_sql_for_question(self, question):
-        return self.questions.get(question)
\ No newline at end of file
+        return self.questions.get(question)
+
+    def load_hits(self):
+        if os.path.exists(self.hits_file):
+            with open(self.hits_file, 'r') as f:
+                return json.load(f)
+        return {}
+
+    def save_hits(self):
+        with open(self.hits_file, 'w') as f:
+            json.dump(self.hits, f, indent=2)
+
+    def record_hit(self, question):
+        with self.hits_lock:
+            self.hits[question] = self.hits.get(question, 0) + 1
+            self.save_hits()
+
+    def get_popular_questions(self, count):
+        with self.hits_lock:
+            hits_snapshot = list(self.hits.items())
+        saved_hits = [(question, hits) for question, hits in hits_snapshot if question in self.questions]
+        saved_hits.sort(key=lambda item: item[1], reverse=True)
+        return [question for question, _ in saved_hits[:count]]
@@ -42,17 +42,25 @@ class Terminal:
     The more details you provide, the better the AI can help you get the right information, even if you don't know the exact table names or SQL terminology.
     """
 
-    def __init__(self, tries=2):
+    def __init__(self, tries=2, compact_results=None, refresh_answers=None):
         """
         Initialize the SQLQueriesTerminal instance.
 
         Args:
             tries (int): The number of attempts to make when generating SQL queries (passed to NLtoSQL).
+            compact_results (bool): Whether to shrink the memory footprint of query results (passed to NLtoSQL).
+                                    If None, the saved preference is used or the user is asked.
+            refresh_answers (bool): Whether to precompute the answers of popular saved questions in the background.
+                                    If None, the saved preference is used or the user is asked.
         """
         self.__connection = None
+        self.__refresh_connection = None
         self.__sql_retriever = None
         self.__claude_client = None
         self.__tries = tries
+        self.__compact_results = compact_results
+        self.__refresh_answers = refresh_answers
+        self.__connection_string = None
         self.__encryption_key = self.__get_or_create_key()
 
     def start_session(self):
@@ -71,8 +79,18 @@ class Terminal:
         if not self.__setup_api_key():
             return
 
-        self.__sql_retriever = NLtoSQL(tries=2)
-        self.__sql_retriever.connect_to_server(self.__connection)
+        self.__setup_preferences()
+
+        self.__sql_retriever = NLtoSQL(tries=2, compact_results=self.__compact_results)
+        refresh_answers = self.__refresh_answers and self.__sql_retriever.question_db.get_popular_questions(1)
+        if refresh_answers:
+            try:
+                # A second connection lets precomputed answers refresh without blocking user queries
+                self.__refresh_connection = pyodbc.connect(self.__connection_string, timeout=10)
+            except pyodbc.Error:
+                self.__refresh_connection = None
+        self.__sql_retriever.connect_to_server(self.__connection, self.__refresh_connection,
+                                               refresh_answers=bool(refresh_answers))
 
         utils.nice_print("\nSetup complete! You can now start querying the database.\n"
                          "Type 'help' for explanation on how to write queries for this bot.\n"
@@ -91,7 +109,14 @@ class Terminal:
                                      "To clarify, requests might fail even if they are suitable so "
                                      "feel free to try again.\n")
 
+        self.__sql_retriever.disconnect_from_server()
         self.__connection.close()
+        if self.__refresh_connection:
+            try:
+                self.__refresh_connection.close()
+            except pyodbc.Error:
+                # A refresh query that outlived the stop timeout may still hold the connection
+                pass
 
     def __setup_connection(self):
         """
@@ -144,6 +169,7 @@ class Terminal:
 
                     self.__connection = pyodbc.connect(conn_str, timeout=10)
                     utils.nice_print(f"Connection successful using {driver}")
+                    self.__connection_string = conn_str
                     break
                 except pyodbc.Error as e:
                     utils.nice_print(f"Connection failed with {driver}")
@@ -208,11 +234,40 @@ class Terminal:
                 if retry.lower() != 'y':
                     return False
 
+    def __setup_preferences(self):
+        """
+        Load the saved session preferences, prompting the user for any that were not saved yet.
+        """
+        preferences_file = utils.resource_path("Data/preferences.json")
+        preferences = {}
+        if os.path.exists(preferences_file):
+            with open(preferences_file, "r") as f:
+                preferences = json.load(f)
+
+        questions = {
+            "compact_results": "Would you like to compact large query results to save memory? (y/n): ",
+            "refresh_answers": "Would you like to precompute the answers of your most reused saved questions "
+                               "in the background? (y/n): "
+        }
+        missing = [key for key in questions if key not in preferences]
+        for key in missing:
+            preferences[key] = input(questions[key]).lower() == 'y'
+        if missing:
+            with open(preferences_file, "w") as f:
+                json.dump(preferences, f)
+            utils.nice_print(f"Preferences saved, you can change them in '{preferences_file}'.")
+
+        if self.__compact_results is None:
+            self.__compact_results = preferences["compact_results"]
+        if self.__refresh_answers is None:
+            self.__refresh_answers = preferences["refresh_answers"]
+
     def __run_question(self, question):
         for i in range(self.__tries):
             if not question:
                 return True
             sql_codes, tables, saved_code = self.__sql_retriever.apply(question)
+            self.__report_token_usage()
             if sql_codes:
                 for code in sql_codes:
                     print(code[0] + '\n')
@@ -234,6 +289,17 @@ class Terminal:
         utils.nice_print("I am sorry I wasn't able to help you, I hope to do better in the future.\n")
         return True
 
+    def __report_token_usage(self):
+        """
+        Print how many input tokens prompt caching saved while answering the last question.
+        """
+        usage = self.__sql_retriever.get_token_usage()
+        cache_read = sum(attempt["cache_read_input_tokens"] for attempt in usage)
+        if cache_read:
+            net_saved = sum(attempt["net_saved_input_tokens"] for attempt in usage)
+            utils.nice_print(f"Prompt caching reused {cache_read} input tokens over {len(usage)} model calls "
+                             f"(net saving of about {net_saved} input tokens).")
+
     def __handle_results(self, tables):
         """
         Handle the results of a SQL query, displaying them and offering to save them.
@@ -5,6 +5,7 @@ import sys
 import tkinter as tk
 from tkinter import filedialog
 from decimal import Decimal
+import pandas as pd
 
 def nice_print(text, width=120):
     """
@@ -39,9 +40,14 @@ def get_tags_info(massage, tag):
     return massage[start_index:end_index].strip()
 
 
+def is_text_dtype(series):
+    """Check if a column holds text, either as object dtype or as a pandas string dtype."""
+    return pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)
+
+
 def is_date_format(series):
-    # Check if the column is object type and not empty
-    if series.dtype == 'object' and not series.empty:
+    # Check if the column is a text type and not empty
+    if is_text_dtype(series) and series.notna().any():
         # Check the first non-null value
         first_value = series.dropna().iloc[0]
         if isinstance(first_value, str):
@@ -50,6 +56,62 @@ def is_date_format(series):
     return False
 
 
+def compact_dataframe(df, category_ratio=0.5):
+    """
+    Shrink the memory footprint of a query result DataFrame.
+
+    Date-like text columns are parsed into real datetimes, low-cardinality text columns become
+    categoricals and numeric columns are downcast to the smallest signed type that keeps every value.
+
+    Args:
+        df (pd.DataFrame): The DataFrame to compact.
+        category_ratio (float): Maximum unique-to-total ratio for a text column to become categorical.
+
+    Returns:
+        pd.DataFrame: A compacted copy of the DataFrame.
+    """
+    compacted = df.copy()
+    # Columns are accessed by position since joins often return duplicate column names
+    for i in range(compacted.shape[1]):
+        series = compacted.iloc[:, i]
+        if is_date_format(series):
+            parsed = pd.to_datetime(series, format='%Y-%m-%d', errors='coerce')
+            # Only keep the conversion if no value was lost on the way
+            if parsed.notna().sum() == series.notna().sum():
+                compacted.isetitem(i, parsed)
+                continue
+        if pd.api.types.is_bool_dtype(series):
+            continue
+        elif is_text_dtype(series):
+            non_null = series.dropna()
+            if not non_null.empty and non_null.map(type).eq(str).all() \
+                    and series.nunique() / len(series) <= category_ratio:
+                compacted.isetitem(i, series.astype('category'))
+        elif pd.api.types.is_integer_dtype(series):
+            # Always signed, unsigned columns wrap around when subtracted from each other
+            compacted.isetitem(i, pd.to_numeric(series, downcast='integer'))
+        elif pd.api.types.is_float_dtype(series):
+            downcast = pd.to_numeric(series, downcast='float')
+            # float32 loses precision for most values, keep it only when nothing changed
+            if downcast.astype(series.dtype).equals(series):
+                compacted.isetitem(i, downcast)
+    return compacted
+
+
+def memory_size(df):
+    """Return the deep memory usage of a DataFrame in bytes."""
+    return int(df.memory_usage(deep=True).sum())
+
+
+def format_bytes(size):
+    """Format a byte count as a human readable string."""
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
     if getattr(sys, 'frozen', False):